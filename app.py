@@ -3,7 +3,6 @@
 # ======================================================
 from dotenv import load_dotenv
 import os
-import secrets
 
 load_dotenv()
 
@@ -13,42 +12,62 @@ IS_PROD = FLASK_ENV == "production"
 FLASK_SECRET_KEY = os.getenv("FLASK_SECRET_KEY")
 PIX_WEBHOOK_SECRET = os.getenv("PIX_WEBHOOK_SECRET")
 SOCKETIO_TOKEN = os.getenv("SOCKETIO_TOKEN")
+REDIS_URL = os.getenv("REDIS_URL")
+SOCKETIO_ASYNC_MODE = os.getenv("SOCKETIO_ASYNC_MODE", "threading")
+PDF_ACCEL_REDIRECT = os.getenv("PDF_ACCEL_REDIRECT")  # ex.: /_internal_pdfs
+PDF_DIR = os.getenv("PDF_DIR", "/var/tmp/pix_pdfs")
+PIX_ACK_DURAVEL = os.getenv("PIX_ACK_DURAVEL") == "1"
 
 if not FLASK_SECRET_KEY or not PIX_WEBHOOK_SECRET or not SOCKETIO_TOKEN:
     raise RuntimeError("Variáveis de ambiente não configuradas")
 
+_PIX_SECRET_BYTES = PIX_WEBHOOK_SECRET.encode("utf-8")
+
 # ======================================================
 # IMPORTS
 # ======================================================
 import hmac
 import hashlib
+import math
 import time
 import io
-from datetime import datetime
-from threading import Thread
-from functools import wraps
-from collections import defaultdict
+import atexit
+import unicodedata
+from datetime import datetime, timedelta
+from threading import Thread, Lock, get_ident
+from functools import wraps, lru_cache
+from collections import deque, OrderedDict
+from queue import Queue, Empty, Full
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, Future
 
 from flask import (
-    Flask, render_template, request, jsonify,
+    Flask, Response, render_template, request, jsonify,
     send_file, redirect, session, abort
 )
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, join_room
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 
 from database import (
     init_db,
-    salvar_pix,
+    salvar_pix_many,
     resumo_do_dia,
+    listar_pix_por_dia,
     fechar_dia,
     buscar_fechamento,
-    autenticar_usuario,
+    buscar_usuario_login,
+    verificar_senha,
     listar_usuarios,
     criar_usuario,
     alterar_status_usuario
 )
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 # ======================================================
 # LOGS (SAFE)
 # ======================================================
@@ -61,24 +80,87 @@ except Exception:
 # ======================================================
 # RATE LIMIT
 # ======================================================
-login_attempts = defaultdict(list)
-webhook_hits = defaultdict(list)
+# Com REDIS_URL o contador é compartilhado entre workers; sem Redis (ou se
+# ele cair) vale o limite local de cada processo.
+_redis = None
+if REDIS_URL:
+    try:
+        import redis
+        _redis = redis.Redis.from_url(
+            REDIS_URL, socket_timeout=0.2, socket_connect_timeout=0.1
+        )
+    except Exception:
+        _redis = None
+
+# disjuntor: depois de uma falha o Redis fica de fora por _REDIS_PAUSA
+# segundos, em vez de cada requisição pagar os timeouts de novo enquanto
+# ele estiver fora do ar. [pausado_até (monotonic)]
+_REDIS_PAUSA = 30
+_redis_pausa = [0.0]
+
+def _redis_ativo():
+    return _redis is not None and time.monotonic() >= _redis_pausa[0]
+
+def _redis_falhou():
+    _redis_pausa[0] = time.monotonic() + _REDIS_PAUSA
+
+login_attempts = {}
+webhook_hits = {}
+_rate_lock = Lock()
+
+def _rate_limit_redis(nome, ip, max_hits, window):
+    chave = f"rl:{nome}:{ip}:{int(time.time() // window)}"
+    pipe = _redis.pipeline()
+    pipe.incr(chave)
+    pipe.expire(chave, window)
+    hits, _ = pipe.execute()
+    return hits <= max_hits
+
+def _rate_limit(nome, hits, ip, max_hits, window):
+    if _redis_ativo():
+        try:
+            return _rate_limit_redis(nome, ip, max_hits, window)
+        except Exception:
+            _redis_falhou()
 
-def rate_limit_login(ip, max_attempts=5, window=300):
     now = time.time()
-    login_attempts[ip] = [t for t in login_attempts[ip] if now - t < window]
-    if len(login_attempts[ip]) >= max_attempts:
-        return False
-    login_attempts[ip].append(now)
-    return True
+    with _rate_lock:
+        # reinsere o IP no fim: o dict fica ordenado pelo último acesso
+        dq = hits.pop(ip, None)
+        if dq is None:
+            dq = deque(maxlen=max_hits)
+        hits[ip] = dq
+
+        # descarta IPs parados há mais de uma janela (sempre no início)
+        oldest = next(iter(hits))
+        while oldest != ip and now - hits[oldest][-1] >= window:
+            del hits[oldest]
+            oldest = next(iter(hits))
+
+        if len(dq) == max_hits and now - dq[0] < window:
+            return False
+        dq.append(now)
+        return True
+
+def rate_limit_login(ip, max_attempts=5, window=300):
+    return _rate_limit("login", login_attempts, ip, max_attempts, window)
 
 def rate_limit_webhook(ip, max_hits=30, window=60):
-    now = time.time()
-    webhook_hits[ip] = [t for t in webhook_hits[ip] if now - t < window]
-    if len(webhook_hits[ip]) >= max_hits:
-        return False
-    webhook_hits[ip].append(now)
-    return True
+    return _rate_limit("webhook", webhook_hits, ip, max_hits, window)
+
+# ======================================================
+# DATA DO DIA
+# ======================================================
+# [expira_em (epoch da próxima meia-noite), "YYYY-MM-DD"]
+_hoje_cache = [0.0, ""]
+
+def data_hoje():
+    if time.time() >= _hoje_cache[0]:
+        agora = datetime.now()
+        amanha = datetime.combine(agora.date() + timedelta(days=1), datetime.min.time())
+        _hoje_cache[1] = agora.strftime("%Y-%m-%d")
+        _hoje_cache[0] = amanha.timestamp()
+    return _hoje_cache[1]
 
 # ======================================================
 # APP
@@ -89,60 +171,98 @@ app.config["SECRET_KEY"] = FLASK_SECRET_KEY
 app.config.update(
     SESSION_COOKIE_HTTPONLY=True,
     SESSION_COOKIE_SAMESITE="Lax",
-    SESSION_COOKIE_SECURE=IS_PROD
+    SESSION_COOKIE_SECURE=IS_PROD,
+    # payloads PIX têm poucos KB; corpos maiores voltam 413 antes do HMAC
+    MAX_CONTENT_LENGTH=64 * 1024
 )
 
-socketio = SocketIO(app, async_mode="threading")
+# threading + simple-websocket já serve WebSocket de verdade (sem cair para
+# long-polling); SOCKETIO_ASYNC_MODE=eventlet para rodar com
+# "gunicorn -k eventlet -w 1 app:app".
+socketio = SocketIO(app, async_mode=SOCKETIO_ASYNC_MODE)
 init_db()
 
 # ======================================================
 # CSRF
 # ======================================================
-@app.context_processor
-def inject_csrf():
-    return dict(csrf_token=session.get("csrf_token"))
+# tokens de 16 bytes fatiados de um bloco de os.urandom: uma syscall a cada
+# 256 tokens, cada fatia continua vindo do CSPRNG do sistema. Um worker
+# criado por fork depois do import (gunicorn --preload) herdaria o mesmo
+# bloco do pai e repetiria os tokens dos irmãos; por isso o filho refaz o
+# bloco (e o lock, que podia estar preso no fork).
+class _TokenPool:
+    def __init__(self, n=4096):
+        self.n = n
+        self._recarregar()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._recarregar)
+
+    def _recarregar(self):
+        self.buf = os.urandom(self.n)
+        self.i = 0
+        self.lock = Lock()
+
+    def take(self):
+        with self.lock:
+            if self.i + 16 > self.n:
+                self.buf = os.urandom(self.n)
+                self.i = 0
+            out = self.buf[self.i:self.i + 16]
+            self.i += 16
+        return out.hex()
+
+_csrf_pool = _TokenPool()
+
+def _csrf_ok(form_tok):
+    sess_tok = (session.get("csrf_token") or "").encode()
+    form_tok = (form_tok or "").encode()
+    return len(form_tok) == len(sess_tok) == 32 and hmac.compare_digest(form_tok, sess_tok)
+
+# global do Jinja: só consulta a sessão nos templates que usam o token
+app.jinja_env.globals["csrf_token"] = lambda: session.get("csrf_token", "")
 
 # ======================================================
 # SECURITY HEADERS
 # ======================================================
+_SEC_HEADERS = [
+    ("X-Frame-Options", "DENY"),
+    ("X-Content-Type-Options", "nosniff"),
+    ("Referrer-Policy", "strict-origin"),
+    ("Permissions-Policy", "geolocation=(), camera=(), microphone=()"),
+]
+if IS_PROD:
+    _SEC_HEADERS.append(
+        ("Strict-Transport-Security", "max-age=63072000; includeSubDomains")
+    )
+
 @app.after_request
 def security_headers(resp):
-    resp.headers["X-Frame-Options"] = "DENY"
-    resp.headers["X-Content-Type-Options"] = "nosniff"
-    resp.headers["Referrer-Policy"] = "strict-origin"
-    if IS_PROD:
-        resp.headers["Strict-Transport-Security"] = "max-age=63072000; includeSubDomains"
+    resp.headers.extend(_SEC_HEADERS)
     return resp
 
+@app.errorhandler(429)
+def too_many_requests(e):
+    log_event("rate_limit", ip=request.remote_addr, extra=request.path)
+    return e
+
 # ======================================================
 # DECORATORS
 # ======================================================
-def login_required(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        if "user_id" not in session:
-            return redirect("/login")
-        return f(*args, **kwargs)
-    return wrapper
-
-def role_required(role):
+# login + tipo + empresa numa camada só: um frame por requisição em vez de três
+def auth_required(role=None, empresa=False):
     def decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            if session.get("tipo") != role:
+            if "user_id" not in session:
+                return redirect("/login")
+            if role and session.get("tipo") != role:
+                abort(403)
+            if empresa and "empresa_id" not in session:
                 abort(403)
             return f(*args, **kwargs)
         return wrapper
     return decorator
 
-def empresa_required(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        if "empresa_id" not in session:
-            abort(403)
-        return f(*args, **kwargs)
-    return wrapper
-
 # ======================================================
 # ROTAS
 # ======================================================
@@ -158,10 +278,24 @@ def logout():
 # ======================================================
 # LOGIN
 # ======================================================
+# A busca no banco roda na própria requisição; o hash da senha vai para um
+# pool limitado. O scrypt/pbkdf2 do hashlib já solta o GIL, então threads
+# bastam: o pool só evita que uma rajada de logins rode um KDF por thread
+# do servidor (CPU e ~16 MB de RAM por scrypt).
+_KDF_POOL = ThreadPoolExecutor(
+    max_workers=os.cpu_count() or 2, thread_name_prefix="kdf"
+)
+
+def _autenticar(username, senha):
+    row = buscar_usuario_login(username)
+    if row and _KDF_POOL.submit(verificar_senha, row[1], senha).result():
+        return row[0], row[2], row[3]  # id, tipo, empresa_id
+    return None
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     if "csrf_token" not in session:
-        session["csrf_token"] = secrets.token_hex(16)
+        session["csrf_token"] = _csrf_pool.take()
 
     if request.method == "POST":
         ip = request.remote_addr
@@ -169,10 +303,10 @@ def login():
         if not rate_limit_login(ip):
             abort(429)
 
-        if request.form.get("csrf_token") != session.get("csrf_token"):
+        if not _csrf_ok(request.form.get("csrf_token")):
             abort(403)
 
-        user = autenticar_usuario(
+        user = _autenticar(
             request.form.get("usuario"),
             request.form.get("senha")
         )
@@ -182,7 +316,7 @@ def login():
             session["user_id"] = user[0]
             session["tipo"] = user[1]
             session["empresa_id"] = user[2]
-            session["csrf_token"] = secrets.token_hex(16)
+            session["csrf_token"] = _csrf_pool.take()
 
             log_event("login_sucesso", user=user[0], ip=ip)
             return redirect("/gerente" if user[1] == "gerente" else "/caixa")
@@ -196,18 +330,27 @@ def login():
 # GERENTE
 # ======================================================
 @app.route("/gerente")
-@login_required
-@role_required("gerente")
-@empresa_required
+@auth_required("gerente", empresa=True)
 def gerente():
-    hoje = datetime.now().strftime("%Y-%m-%d")
+    hoje = data_hoje()
     total, quantidade = resumo_do_dia(hoje, session["empresa_id"])
     return render_template("gerente.html", data=hoje, total=total, quantidade=quantidade)
 
+@app.route("/gerente/pix/por-data")
+@auth_required("gerente", empresa=True)
+def gerente_pix_por_data():
+    data = request.args.get("data") or data_hoje()
+    limit = max(1, min(request.args.get("limit", 200, type=int), 500))
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    total, quantidade = resumo_do_dia(data, session["empresa_id"])
+    return jsonify(
+        total=total,
+        quantidade=quantidade,
+        pix=list(listar_pix_por_dia(data, session["empresa_id"], limit, offset))
+    )
+
 @app.route("/gerente/usuarios")
-@login_required
-@role_required("gerente")
-@empresa_required
+@auth_required("gerente", empresa=True)
 def gerente_usuarios():
     return render_template(
         "usuarios.html",
@@ -215,11 +358,9 @@ def gerente_usuarios():
     )
 
 @app.route("/gerente/usuarios/criar", methods=["POST"])
-@login_required
-@role_required("gerente")
-@empresa_required
+@auth_required("gerente", empresa=True)
 def criar_caixa_view():
-    if request.form.get("csrf_token") != session.get("csrf_token"):
+    if not _csrf_ok(request.form.get("csrf_token")):
         abort(403)
 
     criar_usuario(
@@ -233,16 +374,208 @@ def criar_caixa_view():
 # ======================================================
 # CAIXA
 # ======================================================
+# o painel do caixa não depende da sessão: renderizado uma vez só no boot
+# (SOCKETIO_TOKEN só muda com restart)
+with app.test_request_context():
+    _CAIXA_HTML = render_template(
+        "painel_caixa.html", SOCKETIO_TOKEN=SOCKETIO_TOKEN
+    ).encode()
+
 @app.route("/caixa")
-@login_required
-@role_required("caixa")
-@empresa_required
+@auth_required("caixa", empresa=True)
 def caixa():
-    return render_template("painel_caixa.html", SOCKETIO_TOKEN=SOCKETIO_TOKEN)
+    return Response(_CAIXA_HTML, mimetype="text/html")
+
+# ======================================================
+# SOCKET.IO
+# ======================================================
+# cada conexão entra na sala da própria empresa: o aviso de PIX não vaza
+# entre empresas
+@socketio.on("connect")
+def socket_connect():
+    if "empresa_id" not in session:
+        return False
+    join_room(f"empresa_{session['empresa_id']}")
 
 # ======================================================
 # WEBHOOK PIX
 # ======================================================
+# HMAC-SHA256 exigido pelo provedor; a chave é processada uma vez só e
+# cada requisição parte de uma cópia do protótipo
+_HMAC_PROTO = hmac.new(_PIX_SECRET_BYTES, digestmod=hashlib.sha256)
+_WEBHOOK_OK = b'{"ok":true}\n'
+
+# assinatura: os 32 bytes já decodificados do header; compare_digest sobre
+# bytes crus é tempo constante
+def validar_assinatura_pix(payload, assinatura):
+    mac = _HMAC_PROTO.copy()
+    mac.update(payload)
+    return hmac.compare_digest(mac.digest(), assinatura)
+
+# Gravação em lote: o webhook só enfileira e responde; uma única thread
+# grava até 256 PIX por transação, esperando no máximo 50 ms para juntar
+# o lote. Troca consciente: um crash do processo perde o que ainda estava
+# na fila (até ~50 ms de PIX já respondidos com 200 ao provedor); no
+# encerramento normal o atexit esvazia a fila antes de sair.
+# Com PIX_ACK_DURAVEL=1 o webhook espera o commit do lote antes do 200
+# (group commit): nada é confirmado sem estar no banco, ao custo de até
+# ~50 ms a mais por resposta.
+# O writer (e a thread de escrita do logs.py) sobe no import: um worker
+# criado por fork depois do import (gunicorn --preload) não tem essas
+# threads e enfileira PIX que ninguém grava. Rodar sem --preload.
+_pix_q = Queue(maxsize=10_000)
+
+def _gravar_lote(lote):
+    try:
+        _, hora, novos = salvar_pix_many([item for item, _ in lote])
+        gravados = lote
+    except Exception as e:
+        # o lote foi desfeito inteiro: regrava um a um para que só o item
+        # ruim se perca, e ele sai do LRU/Redis para um reenvio poder gravar
+        log_event("pix_erro_lote", extra={"erro": str(e), "itens": len(lote)})
+        gravados, novos, hora = [], [], None
+        for item, fut in lote:
+            try:
+                _, hora, inserido = salvar_pix_many([item])
+            except Exception as e_item:
+                log_event("pix_erro_gravacao", extra={"erro": str(e_item), "paymentId": item[0]})
+                _esquecer_visto(item[0])
+                if fut is not None:
+                    fut.set_exception(e_item)
+            else:
+                gravados.append((item, fut))
+                novos.extend(inserido)
+
+    for _, fut in gravados:
+        if fut is not None:
+            fut.set_result(True)
+
+    # só o que entrou de fato vira aviso (um paymentId repetido que escapou
+    # do LRU não aparece como segundo PIX no caixa); o fan-out do Socket.IO
+    # roda fora da thread do writer, sem atrasar o próximo lote
+    if novos:
+        socketio.start_background_task(_avisar_caixas, novos, hora)
+
+def _avisar_caixas(itens, hora):
+    for _, valor, status, empresa_id in itens:
+        socketio.emit(
+            "pix_received",
+            {"valor": f"{valor:.2f}", "hora": hora, "status": status},
+            to=f"empresa_{empresa_id}"
+        )
+
+def _pix_writer():
+    while True:
+        lote = [_pix_q.get()]
+        limite = time.monotonic() + 0.05
+        while len(lote) < 256:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                lote.append(_pix_q.get(timeout=restante))
+            except Empty:
+                break
+        # o writer é a única thread que grava PIX: se ele morrer, o webhook
+        # segue respondendo 200 para uma fila que ninguém esvazia
+        try:
+            _gravar_lote(lote)
+        except Exception as e:
+            log_event("pix_erro_writer", extra={"erro": repr(e), "itens": len(lote)})
+            for _, fut in lote:
+                if fut is not None and not fut.done():
+                    fut.set_exception(e)
+
+def _pix_flush():
+    lote = []
+    while True:
+        try:
+            lote.append(_pix_q.get_nowait())
+        except Empty:
+            break
+    if lote:
+        _gravar_lote(lote)
+
+Thread(target=_pix_writer, daemon=True).start()
+atexit.register(_pix_flush)
+
+# paymentIds aceitos recentemente (LRU). O banco continua deduplicando via
+# UNIQUE; isto só corta o trabalho dos reenvios do provedor. Um ID cuja
+# gravação falhar é desmarcado pelo writer, e o reenvio grava de novo.
+# Com REDIS_URL os IDs também vão para o Redis (24 h), e um reenvio que cair
+# em outro worker é cortado do mesmo jeito; se o Redis falhar, vale só o LRU
+# (e o disjuntor do rate limit deixa o Redis de fora por um tempo).
+_seen_ids = OrderedDict()
+_seen_lock = Lock()
+_SEEN_MAX = 10_000
+_SEEN_TTL = 86400
+
+def _ja_visto(payment_id):
+    with _seen_lock:
+        if payment_id in _seen_ids:
+            _seen_ids.move_to_end(payment_id)
+            return True
+
+    if _redis_ativo():
+        try:
+            return bool(_redis.exists(f"pix:visto:{payment_id}"))
+        except Exception:
+            _redis_falhou()
+    return False
+
+def _marcar_visto(payment_id):
+    with _seen_lock:
+        _seen_ids[payment_id] = None
+        _seen_ids.move_to_end(payment_id)
+        if len(_seen_ids) > _SEEN_MAX:
+            _seen_ids.popitem(last=False)
+
+    if _redis_ativo():
+        try:
+            _redis.set(f"pix:visto:{payment_id}", 1, ex=_SEEN_TTL)
+        except Exception:
+            _redis_falhou()
+
+def _esquecer_visto(payment_id):
+    with _seen_lock:
+        _seen_ids.pop(payment_id, None)
+
+    if _redis_ativo():
+        try:
+            _redis.delete(f"pix:visto:{payment_id}")
+        except Exception:
+            _redis_falhou()
+
+# campos do payload com tipo errado são recusados aqui com 400: chegando ao
+# writer, um valor que o sqlite não consegue gravar derrubaria o lote todo
+def _item_pix(data):
+    if not isinstance(data, dict):
+        return None
+
+    payment_id = data.get("paymentId", "N/A")
+    status = data.get("status", "CONFIRMADO")
+    amount = data.get("amount", 0)
+    if not isinstance(payment_id, str) or not payment_id:
+        return None
+    if not isinstance(status, str):
+        return None
+    if isinstance(amount, bool) or not isinstance(amount, (int, float, str)):
+        return None
+
+    try:
+        valor = float(amount)
+    except (ValueError, OverflowError):  # int do json acima de ~1e308
+        return None
+    if not math.isfinite(valor):
+        return None
+
+    return (
+        payment_id,
+        valor,
+        status,
+        1  # empresa padrão para webhook externo
+    )
+
 @app.route("/webhook/pix", methods=["POST"])
 def webhook_pix():
     ip = request.remote_addr
@@ -250,64 +583,180 @@ def webhook_pix():
     if not rate_limit_webhook(ip):
         abort(429)
 
-    payload = request.get_data()
-    assinatura = request.headers.get("X-Signature")
-
-    calc = hmac.new(
-        PIX_WEBHOOK_SECRET.encode(),
-        payload,
-        hashlib.sha256
-    ).hexdigest()
+    # SHA-256 em hex tem sempre 64 caracteres: lixo é recusado antes de ler
+    # o corpo e calcular o HMAC
+    assinatura = request.environ.get("HTTP_X_SIGNATURE", "")
+    if not assinatura or len(assinatura) != 64:
+        abort(401)
 
-    if not hmac.compare_digest(calc, assinatura or ""):
+    try:
+        assinatura = bytes.fromhex(assinatura)
+    except ValueError:
         abort(401)
 
-    data = request.json or {}
-    salvar_pix(
-        data.get("paymentId", "N/A"),
-        float(data.get("amount", 0)),
-        data.get("status", "CONFIRMADO"),
-        1  # empresa padrão para webhook externo
-    )
+    if (request.content_length or 0) > app.config["MAX_CONTENT_LENGTH"]:
+        abort(413)
 
-    return jsonify({"ok": True})
+    payload = request.get_data(cache=False)
+
+    if not validar_assinatura_pix(payload, assinatura):
+        abort(401)
+
+    try:
+        data = (json_loads(payload) if payload else None) or {}
+    except ValueError:
+        abort(400)
+    item = _item_pix(data)
+    if item is None:
+        abort(400)
+
+    # reenvio de um paymentId já aceito: só confirma (checado depois do HMAC
+    # para não virar oráculo de IDs)
+    payment_id = item[0]
+    if _ja_visto(payment_id):
+        return Response(_WEBHOOK_OK, mimetype="application/json")
+
+    fut = Future() if PIX_ACK_DURAVEL else None
+    if fut is None:
+        # marcado antes de enfileirar: se a gravação falhar, o writer já
+        # encontra o ID marcado e o desmarca
+        _marcar_visto(payment_id)
+    try:
+        _pix_q.put_nowait((item, fut))
+    except Full:
+        _esquecer_visto(payment_id)
+        abort(503)
+
+    if fut is not None:
+        try:
+            fut.result(timeout=5)
+        except Exception:
+            abort(503)
+        _marcar_visto(payment_id)
+
+    return Response(_WEBHOOK_OK, mimetype="application/json")
 
 # ======================================================
 # RELATÓRIO PDF
 # ======================================================
 @app.route("/relatorio/<data>/pdf")
-@login_required
-@role_required("gerente")
-@empresa_required
+@auth_required("gerente", empresa=True)
 def relatorio_pdf(data):
-    fechamento = buscar_fechamento(data, session["empresa_id"]) or {}
-    total = fechamento.get("total", 0)
-    quantidade = fechamento.get("quantidade", 0)
+    empresa_id = session["empresa_id"]
+    fechamento = buscar_fechamento(data, empresa_id)
+
+    if fechamento and data.replace("-", "").isdigit():
+        # dia fechado não muda mais: o PDF fica em disco por
+        # (empresa, data, fechado_em) e sobrevive a restart e a outros workers
+        selo = "".join(ch for ch in fechamento["fechado_em"] if ch.isdigit())
+        nome = f"relatorio_{empresa_id}_{data}_{selo}_{_PDF_VERSAO}.pdf"
+        total = fechamento["total"]
+        quantidade = fechamento["quantidade"]
+        caminho = _arquivo_pdf_ou_none(nome, total, quantidade)
+        if caminho is None:
+            resp = Response(_pdf_relatorio(total, quantidade), mimetype="application/pdf")
+        elif PDF_ACCEL_REDIRECT:
+            resp = _pdf_accel(nome)
+        else:
+            resp = send_file(caminho, mimetype="application/pdf")
+    else:
+        fechamento = fechamento or {}
+        total = fechamento.get("total", 0)
+        quantidade = fechamento.get("quantidade", 0)
+        nome = f"relatorio_{total:.2f}_{quantidade}_{_PDF_VERSAO}.pdf"
+        if PDF_ACCEL_REDIRECT and _arquivo_pdf_ou_none(nome, total, quantidade):
+            resp = _pdf_accel(nome)
+        else:
+            # bytes já prontos do cache: vão direto no corpo, sem BytesIO nem
+            # o file wrapper do send_file
+            resp = Response(_pdf_relatorio(total, quantidade), mimetype="application/pdf")
+
+    _anexo(resp, f"relatorio_{data}.pdf")
+    return resp
 
+# Content-Disposition como o send_file monta: nome fora do ASCII vai em
+# filename* (RFC 5987), com um filename ASCII de reserva; em latin-1 cru o
+# servidor WSGI não consegue codificar o header
+def _anexo(resp, nome):
+    try:
+        nome.encode("ascii")
+    except UnicodeEncodeError:
+        simples = unicodedata.normalize("NFKD", nome).encode("ascii", "ignore").decode("ascii")
+        quoted = quote(nome, safe="!#$&+-.^_`|~")
+        nomes = {"filename": simples, "filename*": f"UTF-8''{quoted}"}
+    else:
+        nomes = {"filename": nome}
+    resp.headers.set("Content-Disposition", "attachment", **nomes)
+
+# Os PDFs em disco ficam em PDF_DIR. Atrás do nginx quem manda os bytes é o
+# proxy:
+#   location /_internal_pdfs/ { internal; alias /var/tmp/pix_pdfs/; }
+# Cada arquivo é regerado se sumir, então apagar antigos por cron
+# (find /var/tmp/pix_pdfs -mmin +60 -delete) é sempre seguro.
+def _arquivo_pdf(nome, total, quantidade):
+    caminho = os.path.join(PDF_DIR, nome)
+    if not os.path.exists(caminho):
+        os.makedirs(PDF_DIR, exist_ok=True)
+        tmp = f"{caminho}.{os.getpid()}.{get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(_pdf_relatorio(total, quantidade))
+        os.replace(tmp, caminho)
+    return caminho
+
+# PDF_DIR sem permissão ou disco cheio não derruba o relatório: o PDF sai
+# da memória, como antes do cache em disco
+def _arquivo_pdf_ou_none(nome, total, quantidade):
+    try:
+        return _arquivo_pdf(nome, total, quantidade)
+    except OSError as e:
+        log_event("pdf_erro_disco", extra={"erro": str(e), "arquivo": nome})
+        return None
+
+def _pdf_accel(nome):
+    resp = Response(mimetype="application/pdf")
+    resp.headers["X-Accel-Redirect"] = f"{PDF_ACCEL_REDIRECT.rstrip('/')}/{nome}"
+    return resp
+
+# versão do layout do PDF, vai no nome dos arquivos em disco: mudou o que o
+# _pdf_relatorio desenha, sobe a versão e os PDFs antigos deixam de ser
+# servidos (o cron de limpeza apaga o resto)
+_PDF_VERSAO = "v2"
+
+# 1234.5 -> "R$ 1.234,50": troca "," e "." numa passada só (laço em C)
+_BRL = str.maketrans(",.", ".,")
+
+def formatar_brl(valor):
+    return f"R$ {valor:,.2f}".translate(_BRL)
+
+# o PDF só depende de total e quantidade; com invariant=1 o ReportLab não
+# grava data de criação nem ID aleatório, então os bytes podem ser reusados
+@lru_cache(maxsize=256)
+def _pdf_relatorio(total, quantidade):
     buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=A4)
+    c = canvas.Canvas(buffer, pagesize=A4, invariant=1)
     c.setFont("Helvetica-Bold", 22)
     c.drawString(50, 800, "PIX CONTROL")
-    c.drawString(50, 760, f"Total: R$ {total:.2f}")
+    c.drawString(50, 760, f"Total: {formatar_brl(total)}")
     c.drawString(50, 740, f"Quantidade: {quantidade}")
     c.showPage()
     c.save()
-    buffer.seek(0)
-
-    return send_file(buffer, as_attachment=True,
-                     download_name=f"relatorio_{data}.pdf",
-                     mimetype="application/pdf")
+    return buffer.getvalue()
 
 # ======================================================
 # FECHAMENTO AUTO
 # ======================================================
+# time.sleep conta no relógio monotônico: dormir o dia inteiro de uma vez
+# erraria o horário se o relógio de parede mudar (NTP, fuso/DST). Dormindo
+# no máximo 1 h por vez o alvo é recalculado ~24 vezes por dia.
 def fechamento_auto():
     while True:
         agora = datetime.now()
-        if agora.hour == 23 and agora.minute == 59:
-            fechar_dia(agora.strftime("%Y-%m-%d"), 1)
-            time.sleep(70)
-        time.sleep(30)
+        alvo = agora.replace(hour=23, minute=59, second=0, microsecond=0)
+        if alvo <= agora:
+            alvo += timedelta(days=1)
+        while (restante := (alvo - datetime.now()).total_seconds()) > 0:
+            time.sleep(min(restante, 3600))
+        fechar_dia(alvo.strftime("%Y-%m-%d"), 1)
 
 # ======================================================
 # START
@@ -1,46 +1,125 @@
+import os
 import sqlite3
+import threading
+import time
+import weakref
+import atexit
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 
 DB_NAME = "pix.db"
 
+# método dos hashes novos (ex.: "pbkdf2:sha256:600000" para logins mais
+# leves que o scrypt padrão do werkzeug); hashes antigos continuam valendo
+# porque o método vai gravado no próprio hash
+SENHA_HASH_METHOD = os.getenv("SENHA_HASH_METHOD")
+
 # ======================================================
 # CONEXÃO
 # ======================================================
+# Uma conexão por thread, aberta uma vez e reaproveitada: nada de abrir o
+# arquivo e reler o schema a cada chamada, e o cache de statements da
+# conexão fica quente. A conexão mora só no threading.local: quando a
+# thread termina o _Conexao é solto e fecha a conexão (o que desfaz uma
+# transação que tivesse ficado aberta); o WeakSet só serve ao atexit.
+_local = threading.local()
+_conexoes = weakref.WeakSet()
+
+class _Conexao:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __del__(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+# WAL + synchronous=NORMAL: o commit vira um append no WAL em vez de um
+# fsync por escrita, e leituras (resumo_do_dia) não esperam o writer. Em
+# WAL/NORMAL o banco nunca corrompe; só as últimas transações podem se
+# perder se faltar energia antes do checkpoint (queda do processo não perde).
+def _configurar(conn):
+    conn.execute("PRAGMA busy_timeout=5000")
+    _ativar_wal(conn)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")  # 20 MB
+    conn.execute("PRAGMA mmap_size=268435456")  # 256 MB
+
+# o WAL fica gravado no arquivo, então só um banco novo troca de modo; essa
+# troca pode falhar com "database is locked" sem passar pelo busy_timeout
+# quando vários workers abrem o banco ao mesmo tempo, daí as novas tentativas
+def _ativar_wal(conn):
+    for tentativa in range(50):
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            return
+        except sqlite3.OperationalError:
+            if tentativa == 49:
+                raise
+            time.sleep(0.1)
+
 def get_connection():
-    return sqlite3.connect(DB_NAME, check_same_thread=False)
+    atual = getattr(_local, "conexao", None)
+    if atual is None:
+        conn = sqlite3.connect(DB_NAME, check_same_thread=False, cached_statements=256)
+        _configurar(conn)
+        # Row: acesso por índice (como tupla) e por nome; dict(row) é em C
+        conn.row_factory = sqlite3.Row
+        atual = _Conexao(conn)
+        _local.conexao = atual
+        _conexoes.add(atual)
+    elif atual.conn.in_transaction:
+        # as escritas desfazem a própria transação quando falham; isto só
+        # cobre quem escapar disso
+        atual.conn.rollback()
+    return atual.conn
+
+def _fechar_conexoes():
+    for atual in list(_conexoes):
+        atual.conn.close()
+
+atexit.register(_fechar_conexoes)
+
+# ======================================================
+# DATA / HORA
+# ======================================================
+# formatação direta dos inteiros: mesmo texto do strftime, sem passar pelo
+# strftime da libc a cada gravação
+def _data_hora():
+    agora = datetime.now()
+    return (
+        f"{agora.year:04d}-{agora.month:02d}-{agora.day:02d}",
+        f"{agora.hour:02d}:{agora.minute:02d}:{agora.second:02d}"
+    )
+
+def _carimbo():
+    data, hora = _data_hora()
+    return f"{data} {hora}"
 
 # ======================================================
 # MIGRAÇÕES SEGURAS
 # ======================================================
-def migrar_usuarios_empresa():
-    conn = get_connection()
-    cursor = conn.cursor()
+# Rodam dentro da transação do init_db, antes dos índices/trigger que usam
+# empresa_id. O ALTER que falha (coluna já existe) é desfeito só até o
+# SAVEPOINT, sem derrubar o resto do boot.
+def _adicionar_coluna(cursor, tabela, coluna):
+    cursor.execute("SAVEPOINT migracao")
     try:
-        cursor.execute("ALTER TABLE usuarios ADD COLUMN empresa_id INTEGER DEFAULT 1")
-        conn.commit()
+        cursor.execute(f"ALTER TABLE {tabela} ADD COLUMN {coluna}")
     except sqlite3.OperationalError:
-        pass
-    conn.close()
+        cursor.execute("ROLLBACK TO migracao")
+    cursor.execute("RELEASE migracao")
 
-def garantir_empresa_padrao():
-    conn = get_connection()
-    cursor = conn.cursor()
+def migrar_usuarios_empresa(cursor):
+    _adicionar_coluna(cursor, "usuarios", "empresa_id INTEGER DEFAULT 1")
+
+def garantir_empresa_padrao(cursor):
     cursor.execute("UPDATE usuarios SET empresa_id = 1 WHERE empresa_id IS NULL")
-    conn.commit()
-    conn.close()
 
-def migrar_pix_empresa():
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            "ALTER TABLE pix ADD COLUMN empresa_id INTEGER DEFAULT 1"
-        )
-        conn.commit()
-    except sqlite3.OperationalError:
-        pass
-    conn.close()
+def migrar_pix_empresa(cursor):
+    _adicionar_coluna(cursor, "pix", "empresa_id INTEGER DEFAULT 1")
 
 # ======================================================
 # INIT DB (SAAS READY, SEM QUEBRAR O ANTIGO)
@@ -49,6 +128,19 @@ def init_db():
     conn = get_connection()
     cursor = conn.cursor()
 
+    # schema + dados padrão numa transação só: um commit (um fsync) no boot.
+    # IMMEDIATE pega o lock de escrita já no começo: uma transação que
+    # começa lendo e depois escreve tomaria SQLITE_BUSY_SNAPSHOT no WAL quando
+    # vários workers sobem juntos, e isso o busy_timeout não espera.
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        _criar_schema(cursor)
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+
+def _criar_schema(cursor):
     # =====================
     # PLANOS
     # =====================
@@ -105,6 +197,64 @@ def init_db():
         )
     """)
 
+    # =====================
+    # MIGRAÇÕES (BANCOS ANTIGOS)
+    # =====================
+    migrar_usuarios_empresa(cursor)
+    garantir_empresa_padrao(cursor)
+    migrar_pix_empresa(cursor)
+
+    # o resumo_do_dia lê o totais_do_dia, não o pix; o índice serve ao
+    # listar_pix_por_dia (empresa_id = ? AND data = ? ORDER BY hora), que
+    # sai já ordenado do índice. O antigo (empresa_id, data, valor) só
+    # custava manutenção a cada INSERT.
+    cursor.execute("DROP INDEX IF EXISTS idx_pix_empresa_data")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_pix_empresa_data_hora
+        ON pix (empresa_id, data, hora)
+    """)
+
+    # =====================
+    # TOTAIS DO DIA (AGREGADO INCREMENTAL)
+    # =====================
+    # mantido por trigger a cada PIX inserido (INSERT OR IGNORE repetido não
+    # dispara), então o resumo_do_dia lê uma linha em vez de somar o dia
+    cursor.execute("""
+        SELECT 1 FROM sqlite_master
+        WHERE type = 'table' AND name = 'totais_do_dia'
+    """)
+    totais_existiam = cursor.fetchone() is not None
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS totais_do_dia (
+            data TEXT,
+            empresa_id INTEGER,
+            total REAL NOT NULL DEFAULT 0,
+            quantidade INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (data, empresa_id)
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_pix_totais_do_dia
+        AFTER INSERT ON pix
+        BEGIN
+            INSERT INTO totais_do_dia (data, empresa_id, total, quantidade)
+            VALUES (NEW.data, NEW.empresa_id, IFNULL(NEW.valor, 0), 1)
+            ON CONFLICT (data, empresa_id) DO UPDATE SET
+                total = total + excluded.total,
+                quantidade = quantidade + 1;
+        END
+    """)
+
+    if not totais_existiam:
+        cursor.execute("""
+            INSERT INTO totais_do_dia (data, empresa_id, total, quantidade)
+            SELECT data, empresa_id, IFNULL(SUM(valor), 0), COUNT(*)
+            FROM pix
+            GROUP BY data, empresa_id
+        """)
+
     # =====================
     # FECHAMENTO DIÁRIO
     # =====================
@@ -122,66 +272,63 @@ def init_db():
     # =====================
     # DADOS PADRÃO (SAFE)
     # =====================
-    cursor.execute("SELECT COUNT(*) FROM planos")
-    if cursor.fetchone()[0] == 0:
-        cursor.execute("""
-            INSERT INTO planos (nome, preco, max_usuarios, recursos)
-            VALUES (?, ?, ?, ?)
-        """, (
-            "Profissional",
-            199.00,
-            10,
-            "PIX em tempo real, Relatórios, Multiusuários"
-        ))
+    # INSERT OR IGNORE com id fixo: sem SELECT COUNT(*) antes de cada um
+    cursor.execute("""
+        INSERT OR IGNORE INTO planos (id, nome, preco, max_usuarios, recursos)
+        VALUES (1, ?, ?, ?, ?)
+    """, (
+        "Profissional",
+        199.00,
+        10,
+        "PIX em tempo real, Relatórios, Multiusuários"
+    ))
 
-    cursor.execute("SELECT COUNT(*) FROM empresas")
-    if cursor.fetchone()[0] == 0:
-        cursor.execute("""
-            INSERT INTO empresas (nome, plano_id, ativa, criada_em)
-            VALUES (?, 1, 1, ?)
-        """, (
-            "Empresa Padrão",
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        ))
+    cursor.execute("""
+        INSERT OR IGNORE INTO empresas (id, nome, plano_id, ativa, criada_em)
+        VALUES (1, ?, 1, 1, ?)
+    """, (
+        "Empresa Padrão",
+        _carimbo()
+    ))
 
-    cursor.execute("SELECT COUNT(*) FROM usuarios")
-    if cursor.fetchone()[0] == 0:
+    # aqui a sonda fica: sem ela o boot pagaria um hash de senha à toa
+    cursor.execute("SELECT 1 FROM usuarios LIMIT 1")
+    if cursor.fetchone() is None:
         cursor.execute("""
             INSERT INTO usuarios (username, senha, tipo, ativo, empresa_id, criado_em)
             VALUES (?, ?, ?, 1, 1, ?)
         """, (
             "gerente",
-            generate_password_hash("admin123"),
+            _hash_senha("admin123"),
             "gerente",
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            _carimbo()
         ))
 
-    conn.commit()
-    conn.close()
-
-    # MIGRAÇÕES
-migrar_usuarios_empresa()
-garantir_empresa_padrao()
-migrar_pix_empresa()
-
 # ======================================================
 # AUTENTICAÇÃO
 # ======================================================
-def autenticar_usuario(username, senha):
+# SQL das rotas quentes em constantes: o mesmo objeto str volta sempre ao
+# cache de statements da conexão (cached_statements=256), sem reparse
+_SQL_LOGIN = """
+    SELECT id, senha, tipo, empresa_id
+    FROM usuarios
+    WHERE username = ? AND ativo = 1
+"""
+
+def buscar_usuario_login(username):
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT id, senha, tipo, empresa_id
-        FROM usuarios
-        WHERE username = ? AND ativo = 1
-    """, (username,))
+    cursor.execute(_SQL_LOGIN, (username,))
     user = cursor.fetchone()
-    conn.close()
+    return user
 
-    if user and check_password_hash(user[1], senha):
-        return user[0], user[2], user[3]  # id, tipo, empresa_id
+def _hash_senha(senha):
+    if SENHA_HASH_METHOD:
+        return generate_password_hash(senha, method=SENHA_HASH_METHOD)
+    return generate_password_hash(senha)
 
-    return None
+def verificar_senha(senha_hash, senha):
+    return check_password_hash(senha_hash, senha)
 
 # ======================================================
 # USUÁRIOS
@@ -196,66 +343,91 @@ def listar_usuarios(empresa_id):
         ORDER BY criado_em
     """, (empresa_id,))
     rows = cursor.fetchall()
-    conn.close()
     return rows
 
+# with conn: commit no fim ou rollback se a escrita falhar (ex.: username
+# repetido), para a transação não segurar o lock de escrita do banco
 def criar_usuario(username, senha, tipo, empresa_id):
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO usuarios (username, senha, tipo, ativo, empresa_id, criado_em)
-        VALUES (?, ?, ?, 1, ?, ?)
-    """, (
-        username,
-        generate_password_hash(senha),
-        tipo,
-        empresa_id,
-        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    ))
-    conn.commit()
-    conn.close()
+    senha_hash = _hash_senha(senha)
+    with conn:
+        conn.execute("""
+            INSERT INTO usuarios (username, senha, tipo, ativo, empresa_id, criado_em)
+            VALUES (?, ?, ?, 1, ?, ?)
+        """, (
+            username,
+            senha_hash,
+            tipo,
+            empresa_id,
+            _carimbo()
+        ))
 
 def alterar_status_usuario(user_id, ativo):
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE usuarios SET ativo = ? WHERE id = ?", (ativo, user_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute("UPDATE usuarios SET ativo = ? WHERE id = ?", (ativo, user_id))
 
 # ======================================================
 # PIX
 # ======================================================
-def salvar_pix(payment_id, valor, status, empresa_id):
+_SQL_INSERT_PIX = """
+    INSERT OR IGNORE INTO pix
+    (payment_id, valor, status, data, hora, empresa_id)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_RESUMO = """
+    SELECT total, quantidade
+    FROM totais_do_dia
+    WHERE data = ? AND empresa_id = ?
+"""
+
+def salvar_pix_many(itens):
+    # itens: [(payment_id, valor, status, empresa_id), ...] em uma transação;
+    # devolve (data, hora, inseridos), onde inseridos são só os itens que o
+    # INSERT OR IGNORE gravou de fato (paymentId repetido fica de fora). Se
+    # um item falhar o lote inteiro é desfeito (with conn) e a exceção sobe.
     conn = get_connection()
     cursor = conn.cursor()
-    agora = datetime.now()
+    data, hora = _data_hora()
+    inseridos = []
 
-    cursor.execute("""
-        INSERT OR IGNORE INTO pix
-        (payment_id, valor, status, data, hora, empresa_id)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (
-        payment_id,
-        valor,
-        status,
-        agora.strftime("%Y-%m-%d"),
-        agora.strftime("%H:%M:%S"),
-        empresa_id
-    ))
-    conn.commit()
-    conn.close()
+    # execute por item em vez de executemany: o rowcount de cada INSERT diz
+    # se a linha entrou; continua sendo um commit só por lote
+    with conn:
+        for item in itens:
+            payment_id, valor, status, empresa_id = item
+            cursor.execute(_SQL_INSERT_PIX, (
+                payment_id, valor, status, data, hora, empresa_id
+            ))
+            if cursor.rowcount:
+                inseridos.append(item)
+    return data, hora, inseridos
 
 def resumo_do_dia(data, empresa_id):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(_SQL_RESUMO, (data, empresa_id))
+    row = cursor.fetchone()
+    if not row:
+        return 0.0, 0
+    # coluna REAL: o sqlite3 já devolve float (inteiros viram REAL na gravação)
+    total, qtd = row
+    return total, qtd
+
+def listar_pix_por_dia(data, empresa_id, limit=200, offset=0):
+    # página por página e como gerador: quem só itera (ex.: export) não
+    # materializa o dia inteiro
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("""
-        SELECT IFNULL(SUM(valor),0), COUNT(*)
+        SELECT payment_id, valor, status, hora
         FROM pix
         WHERE data = ? AND empresa_id = ?
-    """, (data, empresa_id))
-    total, qtd = cursor.fetchone()
-    conn.close()
-    return float(total), qtd
+        ORDER BY hora
+        LIMIT ? OFFSET ?
+    """, (data, empresa_id, limit, offset))
+    return (dict(r) for r in cursor)
 
 # ======================================================
 # FECHAMENTO
@@ -263,20 +435,18 @@ def resumo_do_dia(data, empresa_id):
 def fechar_dia(data, empresa_id):
     total, qtd = resumo_do_dia(data, empresa_id)
     conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT OR REPLACE INTO fechamento_diario
-        (data, empresa_id, total, quantidade, fechado_em)
-        VALUES (?, ?, ?, ?, ?)
-    """, (
-        data,
-        empresa_id,
-        total,
-        qtd,
-        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    ))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO fechamento_diario
+            (data, empresa_id, total, quantidade, fechado_em)
+            VALUES (?, ?, ?, ?, ?)
+        """, (
+            data,
+            empresa_id,
+            total,
+            qtd,
+            _carimbo()
+        ))
 
 def buscar_fechamento(data, empresa_id):
     conn = get_connection()
@@ -287,13 +457,8 @@ def buscar_fechamento(data, empresa_id):
         WHERE data = ? AND empresa_id = ?
     """, (data, empresa_id))
     row = cursor.fetchone()
-    conn.close()
 
     if not row:
         return None
 
-    return {
-        "total": row[0],
-        "quantidade": row[1],
-        "fechado_em": row[2]
-    }
\ No newline at end of file
+    return dict(row)
\ No newline at end of file
@@ -1,13 +1,55 @@
 from datetime import datetime
-import json
+import atexit
+import queue
+import sys
+import threading
+
+try:
+    from orjson import dumps as _dumps
+except ImportError:
+    import json
+
+    def _dumps(log):
+        return json.dumps(log, default=datetime.isoformat).encode()
+
+# Quem loga só serializa e enfileira; uma thread única escreve no stdout,
+# juntando o que estiver na fila numa escrita só.
+_fila = queue.SimpleQueue()
+
+def _escrever(linhas):
+    out = getattr(sys.stdout, "buffer", None)
+    if out is not None:
+        out.write(b"".join(linhas))
+    else:
+        sys.stdout.write(b"".join(linhas).decode())
+    sys.stdout.flush()
+
+def _drenar(linhas):
+    while True:
+        try:
+            linhas.append(_fila.get_nowait())
+        except queue.Empty:
+            return linhas
+
+def _escritor():
+    while True:
+        _escrever(_drenar([_fila.get()]))
+
+def _flush():
+    linhas = _drenar([])
+    if linhas:
+        _escrever(linhas)
+
+threading.Thread(target=_escritor, daemon=True).start()
+atexit.register(_flush)
 
 def log_event(action, user=None, ip=None, extra=None):
     log = {
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": datetime.utcnow(),
         "action": action,
         "user": user,
         "ip": ip,
         "extra": extra
     }
 
-    print(json.dumps(log))
\ No newline at end of file
+    _fila.put(_dumps(log) + b"\n")